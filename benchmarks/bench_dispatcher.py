@@ -0,0 +1,254 @@
+"""Нагрузочный бенчмарк диспетчера на синтетическом трафике.
+
+Строит апдейты основных пользовательских сценариев и прогоняет их через
+dp.feed_update с MockSession вместо сети, затем печатает p50/p95/p99
+задержки и пропускную способность по каждому обработчику.
+
+    python benchmarks/bench_dispatcher.py --users 100000 --products 10000
+    python benchmarks/bench_dispatcher.py --users 1000 --flows product,add_to_cart --json out.json
+
+Масштаб задается числом пользователей (1k-1M) и товаров (10-100k):
+на больших значениях сразу видно линейные проходы в get_product и
+process_referral.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixtures import (  # noqa: E402
+    MOCK_TOKEN, load_bot_module, make_workdir, percentile, write_dataset,
+)
+from mock_bot_api import MockBotAPI, MockSession  # noqa: E402
+
+from aiogram import Bot  # noqa: E402
+from aiogram.types import CallbackQuery, Chat, Message, Update, User  # noqa: E402
+
+FLOWS = ["start", "categories", "category", "page", "product", "add_to_cart", "ticket", "chat"]
+
+
+class TrafficGenerator:
+    """Фабрика синтетических апдейтов"""
+    
+    def __init__(self, dataset: Dict, shop, seed: int = 42):
+        self.dataset = dataset
+        self.shop = shop
+        self.random = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new_user_ids = itertools.count(2_000_000_000)
+    
+    def new_user_id(self) -> int:
+        return next(self._new_user_ids)
+    
+    def existing_user_id(self) -> int:
+        return self.random.choice(self.dataset["user_ids"])
+    
+    @staticmethod
+    def user(user_id: int) -> User:
+        return User(id=user_id, is_bot=False, first_name="Bench", username=f"user{user_id}")
+    
+    def message(self, user_id: int, text: str) -> Update:
+        return Update(
+            update_id=next(self._update_ids),
+            message=Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(),
+                chat=Chat(id=user_id, type="private"),
+                from_user=self.user(user_id),
+                text=text,
+            ),
+        )
+    
+    def callback(self, user_id: int, data: str) -> Update:
+        return Update(
+            update_id=next(self._update_ids),
+            callback_query=CallbackQuery(
+                id=str(next(self._update_ids)),
+                from_user=self.user(user_id),
+                chat_instance="bench",
+                data=data,
+                message=Message(
+                    message_id=next(self._message_ids),
+                    date=datetime.now(),
+                    chat=Chat(id=user_id, type="private"),
+                    text="🏠 Главное меню",
+                ),
+            ),
+        )
+
+
+def flow_updates(flow: str, gen: TrafficGenerator) -> Iterator[Tuple[str, Update]]:
+    """Один проход сценария: пары (метка, апдейт)"""
+    dataset = gen.dataset
+    shop = gen.shop
+    if flow == "start":
+        code = gen.random.choice(dataset["referral_codes"])
+        yield "handle_start", gen.message(gen.new_user_id(), f"/start {code}")
+    elif flow == "categories":
+        yield "handle_view_categories", gen.callback(gen.existing_user_id(), "view_categories")
+    elif flow == "category":
+        category_id = gen.random.choice(dataset["category_ids"])
+        yield "handle_category_products", gen.callback(gen.existing_user_id(), shop.CATEGORY.pack(category_id))
+    elif flow == "page":
+        # Страница в глубине категории: курсор - случайный товар этой категории
+        product_id = gen.random.choice(dataset["product_ids"])
+        category_id = dataset["product_categories"][product_id]
+        sort = gen.random.choice(["popular", "price", "name"])
+        yield "handle_category_page", gen.callback(gen.existing_user_id(),
+                                                   shop.CATEGORY_PAGE.pack(category_id, sort, product_id, None))
+    elif flow == "product":
+        product_id = gen.random.choice(dataset["product_ids"])
+        yield "handle_product_detail", gen.callback(gen.existing_user_id(), shop.PRODUCT.pack(product_id))
+    elif flow == "add_to_cart":
+        product_id = gen.random.choice(dataset["product_ids"])
+        yield "handle_add_to_cart", gen.callback(gen.existing_user_id(), shop.ADD_TO_CART.pack(product_id))
+    elif flow == "ticket":
+        # Тикет у пользователя может быть только один, поэтому каждый раз новый пользователь
+        user_id = gen.new_user_id()
+        yield "handle_create_ticket", gen.callback(user_id, "create_ticket")
+        yield "handle_ticket_text", gen.message(user_id, "Не пришел товар по заказу, помогите")
+    elif flow == "chat":
+        user_id = gen.random.choice(dataset["chat_user_ids"])
+        yield "handle_chat_message", gen.message(user_id, "Сообщение в чат поддержки")
+    else:
+        raise ValueError(f"Неизвестный сценарий: {flow}")
+
+
+async def prepare_chats(shop, bot: Bot, dp, gen: TrafficGenerator, count: int = 50):
+    """Открыть чаты поддержки, в которые пишет сценарий chat"""
+    chat_user_ids = [gen.new_user_id() for _ in range(count)]
+    for user_id in chat_user_ids:
+        shop.ticket_manager.create_chat(user_id, f"user{user_id}")
+        state = dp.fsm.get_context(bot=bot, chat_id=user_id, user_id=user_id)
+        await state.set_state(shop.TicketStates.chat_mode)
+    gen.dataset["chat_user_ids"] = chat_user_ids
+
+
+async def run_benchmark(args) -> Dict[str, Dict[str, float]]:
+    workdir = make_workdir()
+    print(f"📁 Данные: {workdir}")
+    
+    started = time.perf_counter()
+    dataset = write_dataset(workdir, args.users, args.products, args.categories, args.seed)
+    print(f"🧪 Сгенерировано {args.users} пользователей и {args.products} товаров "
+          f"за {time.perf_counter() - started:.1f} с")
+    
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        shop = load_bot_module(workdir)
+    print(f"⏱️ Импорт бота: {time.perf_counter() - started:.2f} с")
+    
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        await shop.stores.load_critical()
+    print(f"⏱️ Загрузка критичных хранилищ: {time.perf_counter() - started:.2f} с")
+    
+    api = MockBotAPI(latency=args.api_latency_ms / 1000, seed=args.seed)
+    bot = Bot(token=MOCK_TOKEN, session=MockSession(api))
+    bot.session.middleware(shop.api_breaker)
+    bot.session.middleware(shop.ApiMetricsMiddleware())
+    shop.bot = bot
+    dp = shop.dp
+    
+    gen = TrafficGenerator(dataset, shop, args.seed)
+    await prepare_chats(shop, bot, dp, gen)
+    
+    samples: Dict[str, List[float]] = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    
+    async def feed(label: str, update: Update):
+        async with semaphore:
+            t0 = time.perf_counter()
+            await dp.feed_update(bot, update)
+            samples.setdefault(label, []).append(time.perf_counter() - t0)
+    
+    flows = args.flows.split(",") if args.flows else FLOWS
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for flow in flows:
+            for _ in range(args.warmup):
+                for label, update in flow_updates(flow, gen):
+                    await dp.feed_update(bot, update)
+            
+            pending = []
+            for _ in range(args.iterations):
+                steps = list(flow_updates(flow, gen))
+                if len(steps) == 1 and args.concurrency > 1:
+                    pending.append(asyncio.create_task(feed(*steps[0])))
+                else:
+                    # Многошаговые сценарии (тикет) идут строго по порядку
+                    for label, update in steps:
+                        await feed(label, update)
+            await asyncio.gather(*pending)
+    
+    # Сохранения из обработчиков сливаются в групповой коммит - дописываем хвост до закрытия
+    await shop.durable.flush()
+    await bot.session.close()
+    if args.show_metrics:
+        print()
+        print(shop.metrics.render_text())
+    
+    report = {}
+    for label, values in samples.items():
+        values.sort()
+        total = sum(values)
+        report[label] = {
+            "count": len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "mean_ms": total / len(values) * 1000,
+            "updates_per_sec": len(values) / total if total else 0.0,
+        }
+    return report
+
+
+def print_report(report: Dict[str, Dict[str, float]]):
+    header = f"{'обработчик':<28}{'N':>7}{'p50, мс':>11}{'p95, мс':>11}{'p99, мс':>11}{'upd/s':>11}"
+    print()
+    print(header)
+    print("-" * len(header))
+    for label, row in report.items():
+        print(f"{label:<28}{row['count']:>7}{row['p50_ms']:>11.3f}{row['p95_ms']:>11.3f}"
+              f"{row['p99_ms']:>11.3f}{row['updates_per_sec']:>11.1f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк диспетчера на синтетическом трафике")
+    parser.add_argument("--users", type=int, default=1000, help="пользователей в базе (1k-1M)")
+    parser.add_argument("--products", type=int, default=100, help="товаров в каталоге (10-100k)")
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=200, help="проходов каждого сценария")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=1, help="одновременных апдейтов")
+    parser.add_argument("--flows", default="", help=f"через запятую из: {','.join(FLOWS)}")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="задержка ответа mock API")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", dest="json_path", help="сохранить отчет в JSON")
+    parser.add_argument("--show-metrics", action="store_true", help="напечатать метрики самого бота")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.json_path:
+        args.json_path = os.path.abspath(args.json_path)
+    report = asyncio.run(run_benchmark(args))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"params": vars(args), "results": report}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
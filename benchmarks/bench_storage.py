@@ -0,0 +1,190 @@
+"""Микробенчмарки хранилищ: Database, CartManager и TicketManager.
+
+Каждая операция измеряется на нескольких размерах данных. Результаты
+сравниваются с baselines.json из репозитория: если операция стала
+медленнее базовой больше чем в --max-ratio раз, скрипт завершается
+с кодом 1.
+
+    python benchmarks/bench_storage.py                  # сравнить с baseline
+    python benchmarks/bench_storage.py --update-baseline
+    python benchmarks/bench_storage.py --sizes 1000 --max-ratio 2
+
+Размер N означает N пользователей, N/10 товаров и N/100 открытых чатов.
+Базовые значения зависят от машины, поэтому обновлять их стоит на той
+же машине, где потом проверяются изменения.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixtures import load_bot_module, make_workdir, write_dataset  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+def measure(func: Callable[[], object], min_time: float = 0.2, repeat: int = 3) -> float:
+    """Лучшее среднее время одного вызова, секунды"""
+    # Подбираем число вызовов так, чтобы раунд длился не меньше min_time
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - started) / number)
+    return best
+
+
+def bench_size(shop, size: int, seed: int) -> Dict[str, float]:
+    """Измерить все операции на одном размере данных"""
+    rnd = random.Random(seed)
+    workdir = make_workdir()
+    dataset = write_dataset(workdir, users=size, products=max(10, size // 10), seed=seed)
+    os.chdir(workdir)
+    
+    db = shop.Database()
+    shop.db = db
+    cart_manager = shop.CartManager()
+    ticket_manager = shop.TicketManager()
+    
+    user_ids = dataset["user_ids"]
+    product_ids = dataset["product_ids"]
+    category_ids = dataset["category_ids"]
+    
+    cart_user = user_ids[0]
+    for product_id in rnd.sample(product_ids, 5):
+        cart_manager.add_to_cart(cart_user, product_id, 1)
+    
+    # Чаты заполняем напрямую и сохраняем один раз, иначе подготовка квадратичная
+    chat_users = user_ids[:max(1, size // 100)]
+    now = datetime.now().isoformat()
+    for user_id in chat_users:
+        ticket_manager.active_chats[user_id] = {
+            "user_id": user_id,
+            "username": f"user{user_id}",
+            "started_at": now,
+            "is_active": True,
+            "message_history": [
+                {"text": f"Сообщение {i}", "is_from_admin": bool(i % 2), "timestamp": now}
+                for i in range(5)
+            ],
+        }
+    ticket_manager.save_data()
+    
+    # Недавние пользователи лежат в памяти, остальные читаются с диска:
+    # get_user_hot - обращение к недавним, get_user - к случайным из всей базы
+    hot_user_ids = list(db.users.hot)
+    
+    return {
+        "Database.get_user_hot": measure(lambda: db.get_user(rnd.choice(hot_user_ids))),
+        "Database.get_user": measure(lambda: db.get_user(rnd.choice(user_ids))),
+        "Database.get_product": measure(lambda: db.get_product(rnd.choice(product_ids))),
+        "Database.get_products_by_category": measure(
+            lambda: db.get_products_by_category(rnd.choice(category_ids))),
+        "Database.load_data": measure(db.load_data, min_time=0.5, repeat=2),
+        "Database.save_users_data": measure(db.save_users_data, min_time=0.5, repeat=2),
+        "CartManager.get_cart_total": measure(lambda: cart_manager.get_cart_total(cart_user)),
+        "TicketManager.add_message_to_chat": measure(
+            lambda: ticket_manager.add_message_to_chat(rnd.choice(chat_users), "Новое сообщение"),
+            repeat=2),
+    }
+
+
+def run(sizes: List[int], seed: int) -> Dict[str, float]:
+    results: Dict[str, float] = {}
+    # Меряем сериализацию и запись, а не fsync: его цена зависит от диска, а не от кода
+    os.environ.setdefault("FSYNC_POLICY", "off")
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        shop = load_bot_module(make_workdir())
+    
+    for size in sizes:
+        started = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            timings = bench_size(shop, size, seed)
+        for name, seconds in timings.items():
+            results[f"{name}@{size}"] = seconds
+        print(f"📏 N={size}: {time.perf_counter() - started:.1f} с")
+    return results
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], max_ratio: float) -> List[str]:
+    """Напечатать сравнение и вернуть список регрессий"""
+    regressions = []
+    print()
+    print(f"{'операция':<50}{'сейчас, мкс':>14}{'baseline, мкс':>16}{'x':>8}")
+    for key, seconds in results.items():
+        base = baseline.get(key)
+        if base:
+            ratio = seconds / base
+            mark = "  ❌" if ratio > max_ratio else ""
+            print(f"{key:<50}{seconds * 1e6:>14.2f}{base * 1e6:>16.2f}{ratio:>8.2f}{mark}")
+            if ratio > max_ratio:
+                regressions.append(key)
+        else:
+            print(f"{key:<50}{seconds * 1e6:>14.2f}{'—':>16}{'':>8}")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Микробенчмарки хранилищ бота")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="размеры данных через запятую")
+    parser.add_argument("--max-ratio", type=float, default=1.5,
+                        help="во сколько раз операция может быть медленнее baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="записать результаты как baseline")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+    args.baseline = os.path.abspath(args.baseline)
+    
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    results = run(sizes, args.seed)
+    
+    baseline: Dict[str, float] = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f).get("results", {})
+    
+    regressions = compare(results, baseline, args.max_ratio)
+    
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "updated_at": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": dict(sorted(baseline.items())),
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Baseline обновлен: {args.baseline}")
+        return 0
+    
+    if regressions:
+        print(f"\n❌ Регрессии (медленнее baseline больше чем в {args.max_ratio} раз): {len(regressions)}")
+        return 1
+    print("\n✅ Регрессий нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""Общие заготовки для бенчмарков: синтетические данные и загрузка бота.
+
+Бот хранит данные в файлах относительно текущей директории и читает их
+при импорте, поэтому бенчмарк сначала генерирует файлы во временной
+папке, переходит в нее и только потом импортирует модуль бота.
+"""
+
+import importlib.util
+import json
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_MODULE_PATH = os.path.join(ROOT, "nndм.py")
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from mock_bot_api import MOCK_TOKEN  # noqa: E402
+
+FIRST_USER_ID = 1_000_000_000
+
+
+def make_user(user_id: int, rnd: random.Random, now: datetime) -> Dict:
+    """Пользователь в формате users_data.json"""
+    registered = now - timedelta(days=rnd.randint(0, 365), seconds=rnd.randint(0, 86400))
+    return {
+        "balance": 0.0,
+        "total_spent": float(rnd.choice([0, 0, 0, 70, 140, 350])),
+        "total_orders": rnd.randint(0, 3),
+        "registration_date": registered.isoformat(),
+        "last_activity": (registered + timedelta(days=rnd.randint(0, 30))).isoformat(),
+        "referral_code": f"{user_id:08X}"[-8:],
+        "referred_by": None,
+        "referrals": [],
+        "qualified_referrals": 0,
+        "available_rewards": 0,
+        "used_rewards": 0,
+        "username": f"user{user_id}",
+        "first_name": None,
+        "last_name": None,
+    }
+
+
+def make_product(product_id: int, category_id: int, rnd: random.Random) -> Dict:
+    """Товар в формате products_data.json"""
+    return {
+        "id": product_id,
+        "category_id": category_id,
+        "name": f"Аккаунт {rnd.choice(['Мьянма', 'Индия', 'Кения', 'Вьетнам'])} #{product_id}",
+        "price": float(rnd.randint(30, 500)),
+        "description": "Синтетический товар для бенчмарка",
+        "quantity": 9999,
+    }
+
+
+def write_dataset(workdir: str, users: int, products: int, categories: int = 10, seed: int = 42) -> Dict:
+    """Сгенерировать файлы данных бота и вернуть сведения о них"""
+    rnd = random.Random(seed)
+    now = datetime.now()
+    
+    user_ids = [FIRST_USER_ID + i for i in range(users)]
+    with open(os.path.join(workdir, "users_data.json"), "w", encoding="utf-8") as f:
+        # Пишем по частям, чтобы не держать в памяти миллион словарей разом
+        f.write('{"users": {')
+        for i, user_id in enumerate(user_ids):
+            if i:
+                f.write(",")
+            f.write(f'"{user_id}": ')
+            json.dump(make_user(user_id, rnd, now), f, ensure_ascii=False)
+        f.write('}, "transactions": [], "pending_orders": {}}')
+    
+    category_list = [{"id": i, "name": f"Категория {i}"} for i in range(1, categories + 1)]
+    product_list = [make_product(i, rnd.randint(1, categories), rnd) for i in range(1, products + 1)]
+    with open(os.path.join(workdir, "products_data.json"), "w", encoding="utf-8") as f:
+        json.dump({"products": product_list, "categories": category_list}, f, ensure_ascii=False)
+    
+    return {
+        "user_ids": user_ids,
+        "referral_codes": [f"{user_id:08X}"[-8:] for user_id in user_ids[:1000]],
+        "product_ids": [p["id"] for p in product_list],
+        "product_categories": {p["id"]: p["category_id"] for p in product_list},
+        "category_ids": [c["id"] for c in category_list],
+    }
+
+
+def make_workdir() -> str:
+    return tempfile.mkdtemp(prefix="shop_bench_")
+
+
+def load_bot_module(workdir: str):
+    """Импортировать модуль бота с данными из workdir"""
+    os.chdir(workdir)
+    os.environ.setdefault("BOT_TOKEN", MOCK_TOKEN)
+    # Синтетический трафик идет от горстки пользователей с частотой, которую антифлуд режет
+    os.environ.setdefault("THROTTLE_RATE", "0")
+    os.environ.pop("BOT_API_URL", None)
+    
+    spec = importlib.util.spec_from_file_location("shop_bot", BOT_MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["shop_bot"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Перцентиль по уже отсортированной выборке"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
@@ -0,0 +1,445 @@
+"""Локальный заменитель Telegram Bot API для нагрузочного тестирования.
+
+Сервер отвечает на методы, которые использует бот, в формате настоящего
+Bot API и умеет имитировать задержку сети, случайные ошибки и flood-лимиты.
+
+Запуск отдельным процессом:
+
+    python mock_bot_api.py --port 8081 --latency-ms 40 --error-rate 0.01
+
+после чего бот запускается с BOT_API_URL=http://127.0.0.1:8081.
+Для тестов внутри одного процесса есть running_mock_api() и mock_bot(),
+а MockSession подключает ту же имитацию к Bot вообще без сети.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from aiohttp import ClientSession, web
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.base import BaseSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.methods import TelegramMethod
+
+MOCK_TOKEN = "123456789:mock-token-for-local-bot-api"
+MOCK_BOT_ID = 123456789
+
+# Методы, на которые распространяются flood-лимиты Telegram
+FLOOD_LIMITED_METHODS = {
+    "sendMessage", "sendPhoto", "sendDocument",
+    "editMessageText", "editMessageCaption", "editMessageReplyMarkup",
+}
+
+
+class MockBotAPI:
+    """Имитация Bot API: ответы, задержки, ошибки и flood-контроль"""
+    
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        method_latency: Optional[Dict[str, float]] = None,
+        error_rate: float = 0.0,
+        error_methods: Optional[List[str]] = None,
+        chat_rate_limit: float = 0.0,
+        global_rate_limit: float = 0.0,
+        member_status: str = "member",
+        seed: Optional[int] = None,
+    ):
+        """
+        :param latency: базовая задержка ответа, секунды
+        :param jitter: случайная добавка к задержке, секунды
+        :param method_latency: задержка для отдельных методов
+        :param error_rate: доля запросов, на которые отвечаем 500
+        :param error_methods: ограничить ошибки этими методами
+        :param chat_rate_limit: сообщений в секунду на чат (0 - без лимита)
+        :param global_rate_limit: сообщений в секунду на бота (0 - без лимита)
+        :param member_status: статус, который возвращает getChatMember
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.method_latency = method_latency or {}
+        self.error_rate = error_rate
+        self.error_methods = set(error_methods or [])
+        self.chat_rate_limit = chat_rate_limit
+        self.global_rate_limit = global_rate_limit
+        self.member_status = member_status
+        self.member_overrides: Dict[int, str] = {}
+        self.random = random.Random(seed)
+        
+        self.stats: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self._message_id = 0
+        self._update_id = 0
+        self._message_texts: Dict[tuple, str] = {}
+        self._message_markups: Dict[tuple, Any] = {}
+        self._chat_sends: Dict[Any, Deque[float]] = defaultdict(deque)
+        self._updates: List[Dict] = []
+        self._updates_event = asyncio.Event()
+        self.webhook_url: Optional[str] = None
+        self._webhook_session: Optional[ClientSession] = None
+        
+        self.methods: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+            "getMe": self.get_me,
+            "getChatMember": self.get_chat_member,
+            "sendMessage": self.send_message,
+            "sendPhoto": self.send_photo,
+            "sendDocument": self.send_document,
+            "editMessageText": self.edit_message_text,
+            "editMessageCaption": self.edit_message_caption,
+            "editMessageReplyMarkup": self.edit_message_reply_markup,
+            "getUpdates": self.get_updates,
+            "answerCallbackQuery": lambda params: True,
+            "answerInlineQuery": lambda params: True,
+            "setWebhook": self.set_webhook,
+            "deleteWebhook": self.delete_webhook,
+            "getWebhookInfo": self.get_webhook_info,
+            "close": lambda params: True,
+            "logOut": lambda params: True,
+        }
+    
+    # ---------- HTTP ----------
+    
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle_request)
+        app.router.add_post("/_mock/updates", self.handle_inject)
+        app.router.add_get("/_mock/stats", self.handle_stats)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+    
+    async def _on_cleanup(self, app: web.Application):
+        if self._webhook_session is not None:
+            await self._webhook_session.close()
+    
+    async def handle_request(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._read_params(request)
+        status, payload = await self.call(method, params)
+        return web.json_response(payload, status=status)
+    
+    async def handle_inject(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        updates = data if isinstance(data, list) else [data]
+        for update in updates:
+            await self.push_update(update)
+        return web.json_response({"ok": True, "result": len(updates)})
+    
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({method: dict(counters) for method, counters in self.stats.items()})
+    
+    @staticmethod
+    async def _read_params(request: web.Request) -> Dict[str, Any]:
+        if request.content_type == "application/json":
+            return await request.json()
+        
+        params: Dict[str, Any] = dict(request.query)
+        if request.can_read_body:
+            form = await request.post()
+            for key, value in form.items():
+                params[key] = value if isinstance(value, str) else getattr(value, "filename", key)
+        return params
+    
+    # ---------- обработка вызова ----------
+    
+    async def call(self, method: str, params: Dict[str, Any]) -> tuple:
+        """Выполнить метод и вернуть (HTTP-статус, тело ответа)"""
+        started = time.perf_counter()
+        counters = self.stats[method]
+        counters["calls"] += 1
+        
+        delay = self.method_latency.get(method, self.latency)
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        
+        try:
+            handler = self.methods.get(method)
+            if handler is None:
+                counters["not_found"] += 1
+                return 404, self._error(404, "Not Found: method not found")
+            
+            if self.error_rate and (not self.error_methods or method in self.error_methods):
+                if self.random.random() < self.error_rate:
+                    counters["errors"] += 1
+                    return 500, self._error(500, "Internal Server Error: injected by mock")
+            
+            if method in FLOOD_LIMITED_METHODS:
+                retry_after = self._check_flood(params.get("chat_id"))
+                if retry_after:
+                    counters["flood"] += 1
+                    return 429, self._error(
+                        429, f"Too Many Requests: retry after {retry_after}",
+                        parameters={"retry_after": retry_after},
+                    )
+            
+            try:
+                result = handler(params)
+                if asyncio.iscoroutine(result):
+                    result = await result
+            except MockAPIError as e:
+                counters["bad_request"] += 1
+                return e.status, self._error(e.status, e.description)
+            
+            return 200, {"ok": True, "result": result}
+        finally:
+            counters["latency_us"] += int((time.perf_counter() - started) * 1_000_000)
+    
+    @staticmethod
+    def _error(code: int, description: str, **extra) -> Dict[str, Any]:
+        return {"ok": False, "error_code": code, "description": description, **extra}
+    
+    def _check_flood(self, chat_id: Any) -> int:
+        """Вернуть retry_after в секундах, если лимит превышен"""
+        now = time.monotonic()
+        for key, limit in ((chat_id, self.chat_rate_limit), ("__global__", self.global_rate_limit)):
+            if not limit:
+                continue
+            sends = self._chat_sends[key]
+            while sends and now - sends[0] > 1.0:
+                sends.popleft()
+            if len(sends) >= limit:
+                return max(1, int(1.0 - (now - sends[0])) + 1)
+        
+        for key, limit in ((chat_id, self.chat_rate_limit), ("__global__", self.global_rate_limit)):
+            if limit:
+                self._chat_sends[key].append(now)
+        return 0
+    
+    # ---------- методы Bot API ----------
+    
+    def bot_user(self) -> Dict[str, Any]:
+        return {
+            "id": MOCK_BOT_ID,
+            "is_bot": True,
+            "first_name": "Mock Shop",
+            "username": "mock_shop_bot",
+            "can_join_groups": True,
+            "can_read_all_group_messages": False,
+            "supports_inline_queries": True,
+        }
+    
+    def get_me(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return self.bot_user()
+    
+    def get_chat_member(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        user_id = int(params["user_id"])
+        status = self.member_overrides.get(user_id, self.member_status)
+        return {
+            "status": status,
+            "user": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        }
+    
+    def _new_message(self, params: Dict[str, Any], **content) -> Dict[str, Any]:
+        self._message_id += 1
+        chat_id = int(params["chat_id"])
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"},
+            "from": self.bot_user(),
+            **content,
+        }
+        if params.get("reply_markup"):
+            message["reply_markup"] = _json_param(params["reply_markup"])
+        return message
+    
+    def send_message(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        message = self._new_message(params, text=params.get("text", ""))
+        self._message_texts[(message["chat"]["id"], message["message_id"])] = message["text"]
+        self._message_markups[(message["chat"]["id"], message["message_id"])] = params.get("reply_markup")
+        return message
+    
+    def send_photo(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        photo = [{"file_id": str(params.get("photo")), "file_unique_id": "mock", "width": 800, "height": 600}]
+        return self._new_message(params, photo=photo, caption=params.get("caption"))
+    
+    def send_document(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        document = {"file_id": f"doc{self._message_id + 1}", "file_unique_id": "mock",
+                    "file_name": str(params.get("document", "document"))}
+        return self._new_message(params, document=document, caption=params.get("caption"))
+    
+    def _edited(self, params: Dict[str, Any], **content) -> Any:
+        if params.get("inline_message_id"):
+            return True
+        message = self._new_message(params, **content)
+        self._message_id -= 1
+        message["message_id"] = int(params["message_id"])
+        message["edit_date"] = message["date"]
+        return message
+    
+    def edit_message_text(self, params: Dict[str, Any]) -> Any:
+        text = params.get("text", "")
+        key = (int(params.get("chat_id", 0)), int(params.get("message_id", 0)))
+        if not params.get("inline_message_id") and self._message_texts.get(key) == text \
+                and self._message_markups.get(key) == params.get("reply_markup"):
+            raise MockAPIError(400, "Bad Request: message is not modified: specified new message "
+                                    "content and reply markup are exactly the same as a current "
+                                    "content and reply markup of the message")
+        self._message_texts[key] = text
+        self._message_markups[key] = params.get("reply_markup")
+        return self._edited(params, text=text)
+    
+    def edit_message_caption(self, params: Dict[str, Any]) -> Any:
+        return self._edited(params, caption=params.get("caption"))
+    
+    def edit_message_reply_markup(self, params: Dict[str, Any]) -> Any:
+        return self._edited(params, text=self._message_texts.get(
+            (int(params.get("chat_id", 0)), int(params.get("message_id", 0))), ""))
+    
+    def set_webhook(self, params: Dict[str, Any]) -> bool:
+        self.webhook_url = params.get("url") or None
+        return True
+    
+    def delete_webhook(self, params: Dict[str, Any]) -> bool:
+        self.webhook_url = None
+        return True
+    
+    def get_webhook_info(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {"url": self.webhook_url or "", "has_custom_certificate": False,
+                "pending_update_count": len(self._updates)}
+    
+    # ---------- апдейты ----------
+    
+    async def push_update(self, update: Dict[str, Any]):
+        """Поставить апдейт боту: в очередь getUpdates или на webhook"""
+        self._update_id += 1
+        update = {"update_id": self._update_id, **update}
+        
+        if self.webhook_url:
+            if self._webhook_session is None:
+                self._webhook_session = ClientSession()
+            async with self._webhook_session.post(self.webhook_url, json=update) as resp:
+                await resp.read()
+            return
+        
+        self._updates.append(update)
+        self._updates_event.set()
+    
+    async def get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        
+        # Подтвержденные ботом апдейты больше не отдаем
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._updates_event.clear()
+            try:
+                await asyncio.wait_for(self._updates_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+
+class MockAPIError(Exception):
+    """Ошибка Bot API, которую нужно вернуть клиенту"""
+    
+    def __init__(self, status: int, description: str):
+        super().__init__(description)
+        self.status = status
+        self.description = description
+
+
+def _json_param(value: Any) -> Any:
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+
+@asynccontextmanager
+async def running_mock_api(host: str = "127.0.0.1", port: int = 0, **options):
+    """Запустить сервер в текущем event loop.
+
+    Возвращает (api, base_url); порт 0 выбирает свободный порт.
+    """
+    api = MockBotAPI(**options)
+    runner = web.AppRunner(api.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    try:
+        yield api, f"http://{host}:{bound_port}"
+    finally:
+        await runner.cleanup()
+
+
+def mock_bot(base_url: str, token: str = MOCK_TOKEN) -> Bot:
+    """Bot, который ходит в локальный сервер вместо api.telegram.org"""
+    session = AiohttpSession(api=TelegramAPIServer.from_base(base_url))
+    return Bot(token=token, session=session)
+
+
+class MockSession(BaseSession):
+    """Сессия Bot, которая вызывает MockBotAPI напрямую, без HTTP.
+
+    Параметры сериализуются так же, как в AiohttpSession, а ответ проходит
+    через стандартный check_response, поэтому хендлеры получают настоящие
+    объекты aiogram и настоящие исключения.
+    """
+    
+    def __init__(self, api: Optional[MockBotAPI] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.mock_api = api or MockBotAPI()
+    
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None):
+        files: Dict[str, Any] = {}
+        params = {}
+        for key, value in method.model_dump(warnings=False).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if value:
+                params[key] = value
+        
+        status, payload = await self.mock_api.call(method.__api_method__, params)
+        response = self.check_response(
+            bot=bot, method=method, status_code=status, content=json.dumps(payload)
+        )
+        return response.result
+    
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None,
+                             timeout: int = 30, chunk_size: int = 65536,
+                             raise_for_status: bool = True):
+        yield b""
+    
+    async def close(self) -> None:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный mock Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="базовая задержка ответа")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="случайная добавка к задержке")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--chat-rate", type=float, default=0.0, help="лимит сообщений в секунду на чат")
+    parser.add_argument("--global-rate", type=float, default=0.0, help="лимит сообщений в секунду на бота")
+    parser.add_argument("--member-status", default="member", help="статус в getChatMember")
+    args = parser.parse_args()
+    
+    api = MockBotAPI(
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        chat_rate_limit=args.chat_rate,
+        global_rate_limit=args.global_rate,
+        member_status=args.member_status,
+    )
+    print(f"🧪 Mock Bot API: http://{args.host}:{args.port} (токен {MOCK_TOKEN})")
+    web.run_app(api.make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()